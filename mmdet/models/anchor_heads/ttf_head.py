@@ -1,11 +1,13 @@
+import copy
+import functools
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from mmcv.cnn import normal_init, kaiming_init
-import numpy as np
 
 from mmdet.ops import ModulatedDeformConvPack
-from mmdet.core import multi_apply, bbox_areas, force_fp32
+from mmdet.core import bbox_areas, force_fp32
 from mmdet.core.anchor.guided_anchor_target import calc_region
 from mmdet.models.losses import ct_focal_loss, giou_loss
 from mmdet.models.utils import (build_norm_layer, bias_init_with_prob, ConvModule)
@@ -14,6 +16,36 @@ from .anchor_head import AnchorHead
 from ..registry import HEADS
 
 
+def lazy_script(fn):
+    """Compile fn with TorchScript on its first call instead of on import, so that
+    importing the models never fails or slows down because of the compiler."""
+    compiled = []
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        if not compiled:
+            compiled.append(torch.jit.script(fn))
+        return compiled[0](*args)
+
+    return wrapper
+
+
+@lazy_script
+def sigmoid_clamp(x, eps=1e-4):
+    # type: (Tensor, float) -> Tensor
+    return torch.clamp(torch.sigmoid(x), min=eps, max=1 - eps)
+
+
+@lazy_script
+def relu_scale(x, scale):
+    # type: (Tensor, float) -> Tensor
+    return F.relu(x) * scale
+
+
+# the shared loss stays eager, it is only scripted for TTFHead.
+scripted_ct_focal_loss = lazy_script(ct_focal_loss)
+
+
 @HEADS.register_module
 class TTFHead(AnchorHead):
 
@@ -38,7 +70,8 @@ class TTFHead(AnchorHead):
                  beta=0.54,
                  hm_weight=1.,
                  wh_weight=5.,
-                 max_objs=128):
+                 max_objs=128,
+                 channels_last=False):
         super(AnchorHead, self).__init__()
         assert len(planes) in [2, 3, 4]
         shortcut_num = min(len(inplanes) - 1, len(planes))
@@ -58,12 +91,16 @@ class TTFHead(AnchorHead):
         self.hm_weight = hm_weight
         self.wh_weight = wh_weight
         self.max_objs = max_objs
+        self.channels_last = channels_last
         self.fp16_enabled = False
 
         self.down_ratio = base_down_ratio // 2 ** len(planes)
         self.num_fg = num_classes - 1
         self.wh_planes = 4 if wh_agnostic else 4 * self.num_fg
         self.base_loc = None
+        self.feat_locs = None
+        self.gaussian_kernels = None
+        self.target_buffers = None
 
         # repeat upsampling n times. 32x to 4x by default.
         self.deconv_layers = nn.ModuleList([
@@ -82,6 +119,12 @@ class TTFHead(AnchorHead):
         # heads
         self.wh = self.build_head(self.wh_planes, wh_head_conv_num, wh_conv)
         self.hm = self.build_head(self.num_fg, hm_head_conv_num)
+        if self.channels_last:
+            # heads only, the deformable convs of the upsampling layers expect NCHW inputs.
+            self.hm.to(memory_format=torch.channels_last)
+            self.wh.to(memory_format=torch.channels_last)
+
+        self.postprocess = TTFPostprocess(self.down_ratio, self.num_fg, wh_agnostic=wh_agnostic)
 
     def build_shortcut(self,
                        inplanes,
@@ -103,7 +146,7 @@ class TTFHead(AnchorHead):
     def build_upsample(self, inplanes, planes, norm_cfg=None):
         mdcn = ModulatedDeformConvPack(inplanes, planes, 3, stride=1,
                                        padding=1, dilation=1, deformable_groups=1)
-        up = nn.UpsamplingBilinear2d(scale_factor=2)
+        up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
 
         layers = []
         layers.append(mdcn)
@@ -135,7 +178,8 @@ class TTFHead(AnchorHead):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
-        for _, m in self.hm.named_modules():
+        # the last conv is initialized below with the prior bias.
+        for _, m in self.hm[:-1].named_modules():
             if isinstance(m, nn.Conv2d):
                 normal_init(m, std=0.01)
 
@@ -146,6 +190,13 @@ class TTFHead(AnchorHead):
             if isinstance(m, nn.Conv2d):
                 normal_init(m, std=0.001)
 
+    def train(self, mode=True):
+        super(TTFHead, self).train(mode)
+        if not mode:
+            # the target buffers are only needed by the loss, free them for inference.
+            self.target_buffers = None
+        return self
+
     def forward(self, feats):
         """
 
@@ -164,68 +215,63 @@ class TTFHead(AnchorHead):
                     shortcut = self.shortcut_layers[i](feats[-i - 2])
                     x = x + shortcut
 
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+
         hm = self.hm(x)
-        wh = F.relu(self.wh(x)) * self.wh_offset_base
+        wh = relu_scale(self.wh(x), float(self.wh_offset_base))
 
         return hm, wh
 
-    @force_fp32(apply_to=('pred_heatmap', 'pred_wh'))
+    def export(self):
+        """Return a copy of the head compiled with TorchScript for inference.
+
+        The shortcut branches are scripted and frozen by torch.jit.optimize_for_inference,
+        which folds their weights into the graph and fuses the conv + relu pairs, and the
+        postprocess is scripted so that the nms, top-k selection and box decoding run as
+        one graph. Only these parts get faster: the deformable upsampling layers are
+        custom ops which can not be scripted, so they and the heads stay in python.
+
+        The frozen branches do not own their weights anymore, so the copy can neither be
+        saved by state_dict() nor moved by .cuda() / .half(): move the head to its device
+        and precision before exporting it. The head itself is left untouched.
+        Needs torch>=1.10.
+        """
+        head = copy.deepcopy(self).eval()
+        for i, layer in enumerate(head.shortcut_layers):
+            head.shortcut_layers[i] = torch.jit.optimize_for_inference(torch.jit.script(layer))
+        head.postprocess = torch.jit.script(head.postprocess)
+        return head
+
     def get_bboxes(self,
                    pred_heatmap,
                    pred_wh,
                    img_metas,
                    cfg,
                    rescale=False):
-        batch, cat, height, width = pred_heatmap.size()
-        pred_heatmap = pred_heatmap.detach().sigmoid_()
-        wh = pred_wh.detach()
-
-        # perform nms on heatmaps
-        heat = simple_nms(pred_heatmap)  # used maxpool to filter the max score
-
+        batch = pred_heatmap.size(0)
         topk = getattr(cfg, 'max_per_img', 100)
-        # (batch, topk)
-        scores, inds, clses, ys, xs = self._topk(heat, topk=topk)
-        xs = xs.view(batch, topk, 1) * self.down_ratio
-        ys = ys.view(batch, topk, 1) * self.down_ratio
-
-        wh = wh.permute(0, 2, 3, 1).contiguous()
-        wh = wh.view(wh.size(0), -1, wh.size(3))
-        inds = inds.unsqueeze(2).expand(inds.size(0), inds.size(1), wh.size(2))
-        wh = wh.gather(1, inds)
-
-        if not self.wh_agnostic:
-            wh = wh.view(-1, topk, self.num_fg, 4)
-            wh = torch.gather(wh, 2, clses[..., None, None].expand(
-                clses.size(0), clses.size(1), 1, 4).long())
+        # (batch, topk, 4), (batch, topk), (batch, topk)
+        bboxes, scores, clses = self.postprocess(pred_heatmap.detach(), pred_wh.detach(), topk)
 
-        wh = wh.view(batch, topk, 4)
-        clses = clses.view(batch, topk, 1).float()
-        scores = scores.view(batch, topk, 1)
+        # (batch, 2), the max (y, x) of each image.
+        max_shapes = bboxes.new_tensor([img_meta['pad_shape'][:2] for img_meta in img_metas]) - 1
+        bboxes[..., 0::2] = torch.min(bboxes[..., 0::2], max_shapes[:, None, 1:2]).clamp(min=0)
+        bboxes[..., 1::2] = torch.min(bboxes[..., 1::2], max_shapes[:, None, 0:1]).clamp(min=0)
 
-        bboxes = torch.cat([xs - wh[..., [0]], ys - wh[..., [1]],
-                            xs + wh[..., [2]], ys + wh[..., [3]]], dim=2)
+        if rescale:
+            scale_factors = bboxes.new_tensor([img_meta['scale_factor'] for img_meta in img_metas])
+            bboxes /= scale_factors.view(batch, 1, -1)
 
-        result_list = []
+        dets = torch.cat([bboxes, scores[..., None]], dim=2)
         score_thr = getattr(cfg, 'score_thr', 0.01)
-        for batch_i in range(bboxes.shape[0]):
-            scores_per_img = scores[batch_i]
-            scores_keep = (scores_per_img > score_thr).squeeze(-1)
-
-            scores_per_img = scores_per_img[scores_keep]
-            bboxes_per_img = bboxes[batch_i][scores_keep]
-            labels_per_img = clses[batch_i][scores_keep]
-            img_shape = img_metas[batch_i]['pad_shape']
-            bboxes_per_img[:, 0::2] = bboxes_per_img[:, 0::2].clamp(min=0, max=img_shape[1] - 1)
-            bboxes_per_img[:, 1::2] = bboxes_per_img[:, 1::2].clamp(min=0, max=img_shape[0] - 1)
-
-            if rescale:
-                scale_factor = img_metas[batch_i]['scale_factor']
-                bboxes_per_img /= bboxes_per_img.new_tensor(scale_factor)
+        keeps = scores > score_thr
 
-            bboxes_per_img = torch.cat([bboxes_per_img, scores_per_img], dim=1)
-            labels_per_img = labels_per_img.squeeze(-1)
-            result_list.append((bboxes_per_img, labels_per_img))
+        # only the ragged selection is left per image.
+        result_list = []
+        for batch_i in range(batch):
+            keep = keeps[batch_i]
+            result_list.append((dets[batch_i][keep], clses[batch_i][keep]))
 
         return result_list
 
@@ -242,155 +288,139 @@ class TTFHead(AnchorHead):
         hm_loss, wh_loss = self.loss_calc(pred_heatmap, pred_wh, *all_targets)
         return {'losses/ttfnet_loss_heatmap': hm_loss, 'losses/ttfnet_loss_wh': wh_loss}
 
-    def _topk(self, scores, topk):
-        batch, cat, height, width = scores.size()
-
-        # both are (batch, 80, topk)
-        topk_scores, topk_inds = torch.topk(scores.view(batch, cat, -1), topk)
-
-        topk_inds = topk_inds % (height * width)
-        topk_ys = (topk_inds / width).int().float()
-        topk_xs = (topk_inds % width).int().float()
-
-        # both are (batch, topk). select topk from 80*topk
-        topk_score, topk_ind = torch.topk(topk_scores.view(batch, -1), topk)
-        topk_clses = (topk_ind / topk).int()
-        topk_ind = topk_ind.unsqueeze(2)
-        topk_inds = topk_inds.view(batch, -1, 1).gather(1, topk_ind).view(batch, topk)
-        topk_ys = topk_ys.view(batch, -1, 1).gather(1, topk_ind).view(batch, topk)
-        topk_xs = topk_xs.view(batch, -1, 1).gather(1, topk_ind).view(batch, topk)
+    def get_gaussian_kernels(self, max_radius, device):
+        """
 
-        return topk_score, topk_inds, topk_clses, topk_ys, topk_xs
+        Args:
+            max_radius: int.
+            device: torch.device.
 
-    def gaussian_2d(self, shape, sigma_x=1, sigma_y=1):
-        m, n = [(ss - 1.) / 2. for ss in shape]
-        y, x = np.ogrid[-m:m + 1, -n:n + 1]
+        Returns:
+            kernels: tensor, (r + 1, r + 2). the 1d gaussian kernel of radius i at distance j
+                is kernels[i, j], zero beyond the radius. r >= max_radius.
+        """
+        if self.gaussian_kernels is not None:
+            kernels = self.gaussian_kernels
+            if kernels.size(0) > max_radius and kernels.device == device:
+                return kernels
+
+        radiuses = torch.arange(max_radius + 1, dtype=torch.float32, device=device)
+        dists = torch.arange(max_radius + 2, dtype=torch.float32, device=device)
+        sigmas = (2 * radiuses + 1) / 6
+        kernels = torch.exp(-(dists * dists)[None, :] / (2 * sigmas * sigmas)[:, None])
+        kernels[dists[None, :] > radiuses[:, None]] = 0
+        self.gaussian_kernels = kernels
+        return kernels
+
+    def gaussian_1d(self, locs, centers, radiuses):
+        """
 
-        h = np.exp(-(x * x / (2 * sigma_x * sigma_x) + y * y / (2 * sigma_y * sigma_y)))
-        h[h < np.finfo(h.dtype).eps * h.max()] = 0
-        return h
+        Args:
+            locs: tensor, (n,). coordinates of the feature map along one axis.
+            centers: tensor, (num_gt,).
+            radiuses: tensor, (num_gt,).
 
-    def draw_truncate_gaussian(self, heatmap, center, h_radius, w_radius, k=1):
-        h, w = 2 * h_radius + 1, 2 * w_radius + 1
-        sigma_x = w / 6
-        sigma_y = h / 6
-        gaussian = self.gaussian_2d((h, w), sigma_x=sigma_x, sigma_y=sigma_y)
-        gaussian = heatmap.new_tensor(gaussian)
+        Returns:
+            gaussian: tensor, (num_gt, n).
+        """
+        # many boxes share the same radius, the kernels are cached and looked up.
+        kernels = self.get_gaussian_kernels(int(radiuses.max()), locs.device)
+        dists = (locs[None, :] - centers.float()[:, None]).abs().long()
+        dists = dists.clamp(max=kernels.size(1) - 1)
+        return kernels[radiuses.long()[:, None], dists]
 
-        x, y = int(center[0]), int(center[1])
+    def get_feat_locs(self, feat_shape, device):
+        """
 
-        height, width = heatmap.shape[0:2]
+        Args:
+            feat_shape: tuple.
+            device: torch.device.
 
-        left, right = min(x, w_radius), min(width - x, w_radius + 1)
-        top, bottom = min(y, h_radius), min(height - y, h_radius + 1)
+        Returns:
+            ys: tensor, (h,). the row of each pixel of the feature map.
+            xs: tensor, (w,). the column of each pixel of the feature map.
+        """
+        output_h, output_w = feat_shape
+        if self.feat_locs is not None:
+            ys, xs = self.feat_locs
+            if ys.size(0) == output_h and xs.size(0) == output_w and ys.device == device:
+                return ys, xs
 
-        masked_heatmap = heatmap[y - top:y + bottom, x - left:x + right]
-        masked_gaussian = gaussian[h_radius - top:h_radius + bottom,
-                          w_radius - left:w_radius + right]
-        if min(masked_gaussian.shape) > 0 and min(masked_heatmap.shape) > 0:
-            torch.max(masked_heatmap, masked_gaussian * k, out=masked_heatmap)
-        return heatmap
+        ys = torch.arange(output_h, dtype=torch.float32, device=device)
+        xs = torch.arange(output_w, dtype=torch.float32, device=device)
+        self.feat_locs = (ys, xs)
+        return ys, xs
 
-    def target_single_image(self, gt_boxes, gt_labels, feat_shape):
+    def draw_truncate_gaussians(self, centers, h_radiuses, w_radiuses, feat_shape):
         """
 
         Args:
-            gt_boxes: tensor, tensor <=> img, (num_gt, 4).
-            gt_labels: tensor, tensor <=> img, (num_gt,).
+            centers: tensor, (num_gt, 2). the (x, y) peak of each gaussian.
+            h_radiuses: tensor, (num_gt,).
+            w_radiuses: tensor, (num_gt,).
             feat_shape: tuple.
 
         Returns:
-            heatmap: tensor, tensor <=> img, (80, h, w).
-            box_target: tensor, tensor <=> img, (4, h, w) or (80 * 4, h, w).
-            reg_weight: tensor, same as box_target
+            gaussians: tensor, (num_gt, h, w). one gaussian per plane.
         """
-        output_h, output_w = feat_shape
-        heatmap_channel = self.num_fg
+        ys, xs = self.get_feat_locs(feat_shape, centers.device)
 
-        heatmap = gt_boxes.new_zeros((heatmap_channel, output_h, output_w))
-        fake_heatmap = gt_boxes.new_zeros((output_h, output_w))
-        box_target = gt_boxes.new_ones((self.wh_planes, output_h, output_w)) * -1
-        reg_weight = gt_boxes.new_zeros((self.wh_planes // 4, output_h, output_w))
+        # the 2d gaussian is separable, only the 1d profiles of each box are computed.
+        # with sigma = diameter / 6 the kernel never drops below eps inside the radius,
+        # so no extra truncation is needed.
+        gaussian_y = self.gaussian_1d(ys, centers[:, 1], h_radiuses)
+        gaussian_x = self.gaussian_1d(xs, centers[:, 0], w_radiuses)
+        return gaussian_y[:, :, None] * gaussian_x[:, None, :]
 
-        if self.wh_area_process == 'log':
-            boxes_areas_log = bbox_areas(gt_boxes).log()
-        elif self.wh_area_process == 'sqrt':
-            boxes_areas_log = bbox_areas(gt_boxes).sqrt()
-        else:
-            boxes_areas_log = bbox_areas(gt_boxes)
-        boxes_area_topk_log, boxes_ind = torch.topk(boxes_areas_log, boxes_areas_log.size(0))
-
-        if self.wh_area_process == 'norm':
-            boxes_area_topk_log[:] = 1.
-
-        gt_boxes = gt_boxes[boxes_ind]
-        gt_labels = gt_labels[boxes_ind]
-
-        feat_gt_boxes = gt_boxes / self.down_ratio
-        feat_gt_boxes[:, [0, 2]] = torch.clamp(feat_gt_boxes[:, [0, 2]], min=0,
-                                               max=output_w - 1)
-        feat_gt_boxes[:, [1, 3]] = torch.clamp(feat_gt_boxes[:, [1, 3]], min=0,
-                                               max=output_h - 1)
-        feat_hs, feat_ws = (feat_gt_boxes[:, 3] - feat_gt_boxes[:, 1],
-                            feat_gt_boxes[:, 2] - feat_gt_boxes[:, 0])
-
-        # we calc the center and ignore area based on the gt-boxes of the origin scale
-        # no peak will fall between pixels
-        ct_ints = (torch.stack([(gt_boxes[:, 0] + gt_boxes[:, 2]) / 2,
-                                (gt_boxes[:, 1] + gt_boxes[:, 3]) / 2],
-                               dim=1) / self.down_ratio).to(torch.int)
-
-        h_radiuses_alpha = (feat_hs / 2. * self.alpha).int()
-        w_radiuses_alpha = (feat_ws / 2. * self.alpha).int()
-        if self.wh_gaussian and self.alpha != self.beta:
-            h_radiuses_beta = (feat_hs / 2. * self.beta).int()
-            w_radiuses_beta = (feat_ws / 2. * self.beta).int()
-
-        if not self.wh_gaussian:
-            # calculate positive (center) regions
-            r1 = (1 - self.beta) / 2
-            ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s = calc_region(gt_boxes.transpose(0, 1), r1)
-            ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s = [torch.round(x.float() / self.down_ratio).int()
-                                                  for x in [ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s]]
-            ctr_x1s, ctr_x2s = [torch.clamp(x, max=output_w - 1) for x in [ctr_x1s, ctr_x2s]]
-            ctr_y1s, ctr_y2s = [torch.clamp(y, max=output_h - 1) for y in [ctr_y1s, ctr_y2s]]
-
-        # larger boxes have lower priority than small boxes.
-        for k in range(boxes_ind.shape[0]):
-            cls_id = gt_labels[k] - 1
-
-            fake_heatmap = fake_heatmap.zero_()
-            self.draw_truncate_gaussian(fake_heatmap, ct_ints[k],
-                                        h_radiuses_alpha[k].item(), w_radiuses_alpha[k].item())
-            heatmap[cls_id] = torch.max(heatmap[cls_id], fake_heatmap)
+    def assign_box_target(self, box_target, reg_weight, gt_boxes, box_target_inds,
+                          box_target_weights):
+        """Fill the targets of every location with the last gt-box covering it.
 
-            if self.wh_gaussian:
-                if self.alpha != self.beta:
-                    fake_heatmap = fake_heatmap.zero_()
-                    self.draw_truncate_gaussian(fake_heatmap, ct_ints[k],
-                                                h_radiuses_beta[k].item(),
-                                                w_radiuses_beta[k].item())
-                box_target_inds = fake_heatmap > 0
-            else:
-                ctr_x1, ctr_y1, ctr_x2, ctr_y2 = ctr_x1s[k], ctr_y1s[k], ctr_x2s[k], ctr_y2s[k]
-                box_target_inds = torch.zeros_like(fake_heatmap, dtype=torch.uint8)
-                box_target_inds[ctr_y1:ctr_y2 + 1, ctr_x1:ctr_x2 + 1] = 1
+        Args:
+            box_target: tensor, (h, w, 4). filled in place.
+            reg_weight: tensor, (h, w). filled in place.
+            gt_boxes: tensor, (num_gt, 4). sorted by area in descending order.
+            box_target_inds: tensor, (num_gt, h, w). region of each gt-box.
+            box_target_weights: tensor, (num_gt, h, w).
+        """
+        order = torch.arange(1, gt_boxes.size(0) + 1, dtype=torch.float32,
+                             device=gt_boxes.device)
+        covered, gt_inds = box_target_inds.float().mul_(order[:, None, None]).max(dim=0)
+        pos_inds = covered > 0
 
-            if self.wh_agnostic:
-                box_target[:, box_target_inds] = gt_boxes[k][:, None]
-                cls_id = 0
-            else:
-                box_target[(cls_id * 4):((cls_id + 1) * 4), box_target_inds] = gt_boxes[k][:, None]
+        box_target[pos_inds] = gt_boxes[gt_inds[pos_inds]]
+        reg_weight[pos_inds] = box_target_weights.gather(0, gt_inds[None])[0][pos_inds]
 
-            if self.wh_gaussian:
-                local_heatmap = fake_heatmap[box_target_inds]
-                ct_div = local_heatmap.sum()
-                local_heatmap *= boxes_area_topk_log[k]
-                reg_weight[cls_id, box_target_inds] = local_heatmap / ct_div
-            else:
-                reg_weight[cls_id, box_target_inds] = \
-                    boxes_area_topk_log[k] / box_target_inds.sum().float()
+    def get_target_buffers(self, batch, feat_shape, gt_boxes):
+        """
 
+        Args:
+            batch: int.
+            feat_shape: tuple.
+            gt_boxes: tensor. the targets take its type and device.
+
+        Returns:
+            heatmap: tensor, (batch, 80, h, w). filled with 0.
+            box_target: tensor, (batch, h, w, 4) or (batch, h, w, 80 * 4). filled with -1.
+            reg_weight: tensor, (batch, 1, h, w) or (batch, 80, h, w). filled with 0.
+        """
+        output_h, output_w = feat_shape
+        shapes = [(batch, self.num_fg, output_h, output_w),
+                  (batch, output_h, output_w, self.wh_planes),
+                  (batch, self.wh_planes // 4, output_h, output_w)]
+
+        # the targets of the last iteration are consumed, their memory is reused.
+        buffers = self.target_buffers
+        if buffers is None or buffers[0].device != gt_boxes.device or \
+                buffers[0].dtype != gt_boxes.dtype or \
+                any(buf.shape != shape for buf, shape in zip(buffers, shapes)):
+            buffers = tuple(gt_boxes.new_empty(shape) for shape in shapes)
+            self.target_buffers = buffers
+
+        heatmap, box_target, reg_weight = buffers
+        heatmap.zero_()
+        box_target.fill_(-1)
+        reg_weight.zero_()
         return heatmap, box_target, reg_weight
 
     def target_generator(self, gt_boxes, gt_labels, img_metas):
@@ -403,24 +433,155 @@ class TTFHead(AnchorHead):
 
         Returns:
             heatmap: tensor, (batch, 80, h, w).
-            box_target: tensor, (batch, 4, h, w) or (batch, 80 * 4, h, w).
-            reg_weight: tensor, same as box_target.
+            box_target: tensor, (batch, h, w, 4) or (batch, h, w, 80 * 4).
+            reg_weight: tensor, (batch, 1, h, w) or (batch, 80, h, w).
+            the targets are reused buffers of the head, they are only valid until
+            the next call. clone them to keep them around.
+
+        All gt-boxes of the batch are drawn at once, which trades memory for speed: the
+        per-box loop needed a single (h, w) scratch map, this keeps a float and a bool
+        (num_gt, h, w) map of all boxes while the box targets are assigned.
         """
         with torch.no_grad():
             feat_shape = (img_metas[0]['pad_shape'][0] // self.down_ratio,
                           img_metas[0]['pad_shape'][1] // self.down_ratio)
-            heatmap, box_target, reg_weight = multi_apply(
-                self.target_single_image,
-                gt_boxes,
-                gt_labels,
-                feat_shape=feat_shape
-            )
-
-            heatmap, box_target = [torch.stack(t, dim=0).detach() for t in [heatmap, box_target]]
-            reg_weight = torch.stack(reg_weight, dim=0).detach()
+            output_h, output_w = feat_shape
+            batch = len(gt_boxes)
+            reg_groups = self.wh_planes // 4
+
+            heatmap, box_target, reg_weight = self.get_target_buffers(batch, feat_shape,
+                                                                      gt_boxes[0])
+
+            # the gt-boxes of all images are packed and processed at once.
+            gt_img_ids = torch.cat([labels.new_full((labels.size(0),), img_id)
+                                    for img_id, labels in enumerate(gt_labels)])
+            gt_boxes = torch.cat(gt_boxes)
+            gt_labels = torch.cat(gt_labels)
+            if gt_boxes.size(0) == 0:
+                return heatmap, box_target, reg_weight
+
+            if self.wh_area_process == 'log':
+                boxes_areas_log = bbox_areas(gt_boxes).log()
+            elif self.wh_area_process == 'sqrt':
+                boxes_areas_log = bbox_areas(gt_boxes).sqrt()
+            else:
+                boxes_areas_log = bbox_areas(gt_boxes)
+            boxes_area_topk_log, boxes_ind = torch.topk(boxes_areas_log, boxes_areas_log.size(0))
+
+            if self.wh_area_process == 'norm':
+                boxes_area_topk_log[:] = 1.
+
+            # sorted by area over the batch, so the boxes of each image are sorted as well.
+            gt_boxes = gt_boxes[boxes_ind]
+            gt_labels = gt_labels[boxes_ind]
+            gt_img_ids = gt_img_ids[boxes_ind]
+
+            feat_gt_boxes = gt_boxes / self.down_ratio
+            feat_gt_boxes[:, 0::2].clamp_(min=0, max=output_w - 1)
+            feat_gt_boxes[:, 1::2].clamp_(min=0, max=output_h - 1)
+            feat_hs, feat_ws = (feat_gt_boxes[:, 3] - feat_gt_boxes[:, 1],
+                                feat_gt_boxes[:, 2] - feat_gt_boxes[:, 0])
+
+            # we calc the center and ignore area based on the gt-boxes of the origin scale
+            # no peak will fall between pixels
+            ct_ints = (torch.stack([(gt_boxes[:, 0] + gt_boxes[:, 2]) / 2,
+                                    (gt_boxes[:, 1] + gt_boxes[:, 3]) / 2],
+                                   dim=1) / self.down_ratio).to(torch.int)
+
+            h_radiuses_alpha = (feat_hs / 2. * self.alpha).int()
+            w_radiuses_alpha = (feat_ws / 2. * self.alpha).int()
+            if self.wh_gaussian and self.alpha != self.beta:
+                h_radiuses_beta = (feat_hs / 2. * self.beta).int()
+                w_radiuses_beta = (feat_ws / 2. * self.beta).int()
+
+            if not self.wh_gaussian:
+                # calculate positive (center) regions
+                r1 = (1 - self.beta) / 2
+                ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s = calc_region(gt_boxes.transpose(0, 1), r1)
+                ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s = [
+                    torch.round(x.float() / self.down_ratio).int()
+                    for x in [ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s]]
+                ctr_x1s.clamp_(max=output_w - 1)
+                ctr_x2s.clamp_(max=output_w - 1)
+                ctr_y1s.clamp_(max=output_h - 1)
+                ctr_y2s.clamp_(max=output_h - 1)
+
+            # (num_gt, h, w), the gaussians of all gt-boxes are drawn in one pass.
+            gaussians = self.draw_truncate_gaussians(ct_ints, h_radiuses_alpha,
+                                                     w_radiuses_alpha, feat_shape)
+            num_gt = gaussians.size(0)
+
+            # only the occupied (image, class) planes are visited.
+            gt_cls_ids = gt_labels - 1
+            heatmap_keys = gt_img_ids * self.num_fg + gt_cls_ids
+            heatmap_planes = heatmap.view(-1, output_h, output_w)
+            for key in heatmap_keys.unique().tolist():
+                heatmap_planes[key] = gaussians[heatmap_keys == key].max(dim=0)[0]
+
+            # the heatmap is drawn, at most one float (num_gt, h, w) map is kept from here:
+            # the gaussians are freed or turned into the regression weights in place.
+            if self.wh_gaussian:
+                if self.alpha != self.beta:
+                    gaussians = None
+                    gaussians = self.draw_truncate_gaussians(ct_ints, h_radiuses_beta,
+                                                             w_radiuses_beta, feat_shape)
+                box_target_inds = gaussians > 0
+                ct_divs = gaussians.view(num_gt, -1).sum(1)
+                box_target_weights = gaussians.mul_(
+                    (boxes_area_topk_log / ct_divs)[:, None, None])
+            else:
+                gaussians = None
+                ys, xs = self.get_feat_locs(feat_shape, gt_boxes.device)
+                ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s = [
+                    x.float()[:, None] for x in [ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s]]
+                y_inds = (ys[None, :] >= ctr_y1s) & (ys[None, :] <= ctr_y2s)
+                x_inds = (xs[None, :] >= ctr_x1s) & (xs[None, :] <= ctr_x2s)
+                box_target_inds = y_inds[:, :, None] & x_inds[:, None, :]
+                ct_divs = box_target_inds.view(num_gt, -1).sum(1).float()
+                box_target_weights = box_target_inds.float().mul_(
+                    (boxes_area_topk_log / ct_divs)[:, None, None])
+
+            # larger boxes have lower priority than small boxes.
+            reg_keys = gt_img_ids * reg_groups
+            if not self.wh_agnostic:
+                reg_keys = reg_keys + gt_cls_ids
+            box_target_groups = box_target.view(batch, output_h, output_w, reg_groups, 4)
+            for key in reg_keys.unique().tolist():
+                img_id, group_id = divmod(key, reg_groups)
+                inds = reg_keys == key
+                self.assign_box_target(box_target_groups[img_id, :, :, group_id],
+                                       reg_weight[img_id, group_id], gt_boxes[inds],
+                                       box_target_inds[inds], box_target_weights[inds])
 
             return heatmap, box_target, reg_weight
 
+    def get_base_loc(self, pred_wh):
+        """
+
+        Args:
+            pred_wh: tensor, (batch, 4, h, w) or (batch, 80 * 4, h, w).
+
+        Returns:
+            shifts_x: tensor, (1, 1, w). the x location of each column in the image.
+            shifts_y: tensor, (1, h, 1). the y location of each row in the image.
+            both are on the same device and of the same type as pred_wh.
+        """
+        H, W = pred_wh.shape[2:]
+        if self.base_loc is not None:
+            shifts_x, shifts_y = self.base_loc
+            if shifts_x.size(2) == W and shifts_y.size(1) == H and \
+                    shifts_x.device == pred_wh.device and shifts_x.dtype == pred_wh.dtype:
+                return shifts_x, shifts_y
+
+        base_step = self.down_ratio
+        shifts_x = torch.arange(0, (W - 1) * base_step + 1, base_step,
+                                dtype=pred_wh.dtype, device=pred_wh.device)
+        shifts_y = torch.arange(0, (H - 1) * base_step + 1, base_step,
+                                dtype=pred_wh.dtype, device=pred_wh.device)
+        # kept per axis and broadcast against pred_wh, no (2, h, w) grid is built.
+        self.base_loc = (shifts_x.view(1, 1, W), shifts_y.view(1, H, 1))
+        return self.base_loc
+
     def loss_calc(self,
                   pred_hm,
                   pred_wh,
@@ -433,35 +594,26 @@ class TTFHead(AnchorHead):
             pred_hm: tensor, (batch, 80, h, w).
             pred_wh: tensor, (batch, 4, h, w) or (batch, 80 * 4, h, w).
             heatmap: tensor, same as pred_hm.
-            box_target: tensor, same as pred_wh.
-            wh_weight: tensor, same as pred_wh.
+            box_target: tensor, (batch, h, w, 4) or (batch, h, w, 80 * 4).
+            wh_weight: tensor, (batch, 1, h, w) or (batch, 80, h, w).
 
         Returns:
             hm_loss
             wh_loss
         """
         H, W = pred_hm.shape[2:]
-        pred_hm = torch.clamp(pred_hm.sigmoid_(), min=1e-4, max=1 - 1e-4)
-        hm_loss = ct_focal_loss(pred_hm, heatmap) * self.hm_weight
+        pred_hm = sigmoid_clamp(pred_hm)
+        hm_loss = scripted_ct_focal_loss(pred_hm, heatmap) * self.hm_weight
 
         mask = wh_weight.view(-1, H, W)
         avg_factor = mask.sum() + 1e-4
 
-        if self.base_loc is None or H != self.base_loc.shape[1] or W != self.base_loc.shape[2]:
-            base_step = self.down_ratio
-            shifts_x = torch.arange(0, (W - 1) * base_step + 1, base_step,
-                                    dtype=torch.float32, device=heatmap.device)
-            shifts_y = torch.arange(0, (H - 1) * base_step + 1, base_step,
-                                    dtype=torch.float32, device=heatmap.device)
-            shift_y, shift_x = torch.meshgrid(shifts_y, shifts_x)
-            self.base_loc = torch.stack((shift_x, shift_y), dim=0)  # (2, h, w)
+        shifts_x, shifts_y = self.get_base_loc(pred_wh)
 
         # (batch, h, w, 4)
-        pred_boxes = torch.cat((self.base_loc - pred_wh[:, [0, 1]],
-                                self.base_loc + pred_wh[:, [2, 3]]), dim=1).permute(0, 2, 3, 1)
-        # (batch, h, w, 4)
-        boxes = box_target.permute(0, 2, 3, 1)
-        wh_loss = giou_loss(pred_boxes, boxes, mask, avg_factor=avg_factor) * self.wh_weight
+        pred_boxes = torch.stack((shifts_x - pred_wh[:, 0], shifts_y - pred_wh[:, 1],
+                                  shifts_x + pred_wh[:, 2], shifts_y + pred_wh[:, 3]), dim=-1)
+        wh_loss = giou_loss(pred_boxes, box_target, mask, avg_factor=avg_factor) * self.wh_weight
 
         return hm_loss, wh_loss
 
@@ -489,3 +641,76 @@ class ShortcutConv2d(nn.Module):
     def forward(self, x):
         y = self.layers(x)
         return y
+
+
+class TTFPostprocess(nn.Module):
+    """Decode the top-k detections from the heatmap and wh predictions.
+
+    Pure tensor ops. It runs eagerly by default and is scripted by TTFHead.export,
+    which compiles the nms, top-k selection and box assembly into a single graph.
+    Scripting a module needs torch>=1.2 and a scripted module can not be pickled,
+    so the head never scripts it on construction.
+    """
+
+    __constants__ = ['down_ratio', 'num_fg', 'wh_agnostic']
+
+    def __init__(self, down_ratio, num_fg, wh_agnostic=True):
+        super(TTFPostprocess, self).__init__()
+        self.down_ratio = down_ratio
+        self.num_fg = num_fg
+        self.wh_agnostic = wh_agnostic
+
+    def forward(self, pred_heatmap, pred_wh, topk=100):
+        # type: (Tensor, Tensor, int) -> Tuple[Tensor, Tensor, Tensor]
+        """
+
+        Args:
+            pred_heatmap: tensor, (batch, 80, h, w).
+            pred_wh: tensor, (batch, 4, h, w) or (batch, 80 * 4, h, w).
+            topk: int.
+
+        Returns:
+            bboxes: tensor, (batch, topk, 4).
+            scores: tensor, (batch, topk).
+            clses: tensor, (batch, topk).
+        """
+        batch = pred_heatmap.size(0)
+        height = pred_heatmap.size(2)
+        width = pred_heatmap.size(3)
+
+        # the half precision path is for cuda only, the cpu has no half sigmoid and maxpool.
+        if not pred_heatmap.is_cuda:
+            pred_heatmap = pred_heatmap.float()
+
+        # used maxpool to filter the max score
+        heat = simple_nms(pred_heatmap.sigmoid())
+
+        # the topk of all classes is also the topk of each class.
+        scores, inds = torch.topk(heat.reshape(batch, -1), topk)
+
+        # the remainders are subtracted first, so the divisions are exact in float and
+        # neither integer division nor a truncating cast is needed.
+        spatial_inds = inds % (height * width)
+        clses = (inds - spatial_inds).float() / (height * width)
+        xs = (spatial_inds % width).float()
+        ys = (spatial_inds.float() - xs) / width
+
+        # (batch, h * w, 4) or (batch, h * w, 80 * 4), a view without transposing copy.
+        wh = pred_wh.reshape(batch, pred_wh.size(1), -1).transpose(1, 2)
+        # (batch, topk, 4), picked by indexing without expanded index tensors.
+        batch_inds = torch.arange(batch, device=wh.device)[:, None]
+        if self.wh_agnostic:
+            wh = wh[batch_inds, spatial_inds]
+        else:
+            wh = wh.reshape(batch, height * width, self.num_fg, 4)[
+                batch_inds, spatial_inds, clses.long()]
+
+        # on cuda the heatmap and wh map are processed in their own (possibly half)
+        # precision, only the selected detections are cast to fp32 for the box arithmetic.
+        wh = wh.float()
+        xs = xs * self.down_ratio
+        ys = ys * self.down_ratio
+        bboxes = torch.stack((xs - wh[..., 0], ys - wh[..., 1],
+                              xs + wh[..., 2], ys + wh[..., 3]), dim=-1)
+
+        return bboxes, scores.float(), clses
@@ -42,7 +42,9 @@ def sigmoid_focal_loss(pred,
     loss = weight_reduce_loss(loss, weight, reduction, avg_factor)
     return loss
 
+
 def ct_focal_loss(pred, gt, gamma=2.0):
+    # type: (Tensor, Tensor, float) -> Tensor
     """
     Focal loss used in CornerNet & CenterNet. Note that the values in gt (label) are in [0, 1] since
     gaussian is used to reduce the punishment and we treat [0, 1) as neg example.
@@ -102,9 +102,17 @@ def soft_nms(dets, iou_thr, method='linear', sigma=0.5, min_score=1e-3):
     else:
         return new_dets.astype(np.float32), inds.astype(np.int64)
 
+
+@torch.jit.script
 def simple_nms(heat, kernel=3, out_heat=None):
+    # type: (Tensor, int, Optional[Tensor]) -> Tensor
+    """Keep only the local maximums of a heatmap.
+
+    Scripted so that the equality mask, cast and multiply are fused.
+    """
     pad = (kernel - 1) // 2
     hmax = nn.functional.max_pool2d(heat, (kernel, kernel), stride=1, padding=pad)
-    keep = (hmax == heat).float()
-    out_heat = heat if out_heat is None else out_heat
+    keep = (hmax == heat).type_as(heat)
+    if out_heat is None:
+        return heat * keep
     return out_heat * keep
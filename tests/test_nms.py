@@ -5,7 +5,7 @@ CommandLine:
 import numpy as np
 import torch
 
-from mmdet.ops.nms.nms_wrapper import nms
+from mmdet.ops.nms.nms_wrapper import nms, simple_nms
 
 
 def test_nms_device_and_dtypes_cpu():
@@ -68,3 +68,22 @@ def test_nms_device_and_dtypes_gpu():
         surpressed, inds = nms(dets, iou_thr)
         assert dets.dtype == surpressed.dtype
         assert len(inds) == len(surpressed) == 3
+
+
+def test_simple_nms():
+    """
+    CommandLine:
+        xdoctest -m tests/test_nms.py test_simple_nms
+    """
+    heat = torch.Tensor([[0.1, 0.9, 0.2, 0.1],
+                         [0.3, 0.5, 0.2, 0.1],
+                         [0.1, 0.2, 0.1, 0.7],
+                         [0.1, 0.1, 0.1, 0.3]])[None, None]
+    for dtype in (torch.float32, torch.float64):
+        keep = simple_nms(heat.to(dtype))
+        assert keep.dtype == dtype
+        assert keep.nonzero()[:, 2:].tolist() == [[0, 1], [2, 3]]
+        assert torch.equal(keep[keep > 0], heat.to(dtype)[keep > 0])
+
+    out_heat = torch.ones_like(heat)
+    assert simple_nms(heat, 3, out_heat).sum() == 2
@@ -0,0 +1,446 @@
+"""
+pytest tests/test_ttf_head.py
+"""
+import numpy as np
+import torch
+
+
+def _build_ttf_head(**kwargs):
+    from mmdet.models.anchor_heads import TTFHead
+    head = TTFHead(
+        inplanes=(64, 128, 256, 512),
+        head_conv=128,
+        wh_conv=64,
+        hm_head_conv_num=2,
+        wh_head_conv_num=1,
+        num_classes=81,
+        wh_offset_base=16,
+        **kwargs)
+    head.init_weights()
+    return head
+
+
+def _demo_targets_inputs():
+    gt_bboxes = [
+        torch.Tensor([[16., 16., 112., 144.], [40., 48., 72., 80.]]),
+        torch.Tensor([[100., 20., 250., 120.]]),
+    ]
+    gt_labels = [torch.LongTensor([1, 3]), torch.LongTensor([80])]
+    img_metas = [{
+        'pad_shape': (256, 256, 3),
+        'img_shape': (256, 256, 3),
+        'scale_factor': 1.0,
+    } for _ in range(2)]
+    return gt_bboxes, gt_labels, img_metas
+
+
+def test_ttf_head_target_generator():
+    for wh_gaussian in (True, False):
+        head = _build_ttf_head(wh_gaussian=wh_gaussian, beta=0.6)
+        gt_bboxes, gt_labels, img_metas = _demo_targets_inputs()
+        heatmap, box_target, reg_weight = head.target_generator(
+            gt_bboxes, gt_labels, img_metas)
+
+        assert heatmap.shape == (2, 80, 64, 64)
+        assert box_target.shape == (2, 64, 64, 4)
+        assert reg_weight.shape == (2, 1, 64, 64)
+
+        for img_id, (boxes, labels) in enumerate(zip(gt_bboxes, gt_labels)):
+            ct_ints = ((boxes[:, :2] + boxes[:, 2:]) / 2 / 4).int()
+            for (x, y), box, label in zip(ct_ints.tolist(), boxes, labels):
+                # every gt-box has its peak at the center.
+                assert heatmap[img_id, label - 1, y, x] == 1
+                # the smaller box wins the overlapped locations.
+                assert torch.equal(box_target[img_id, y, x], box)
+            # the weights of each box are normalized to its (log) area.
+            areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+            assert reg_weight[img_id].sum() <= areas.log().sum() + 1e-4
+            assert ((reg_weight[img_id, 0] > 0) == (box_target[img_id, ..., 0] >= 0)).all()
+
+    # the targets are reused by the next call, and dropped outside of training.
+    assert head.target_buffers[0].data_ptr() == heatmap.data_ptr()
+    head.eval()
+    assert head.target_buffers is None
+
+    empty_targets = head.target_generator(
+        [torch.zeros((0, 4)), torch.zeros((0, 4))],
+        [torch.LongTensor([]), torch.LongTensor([])], img_metas)
+    assert all(t.abs().sum() == 0 for t in (empty_targets[0], empty_targets[2]))
+
+
+def _reference_gaussian_2d(shape, sigma_x=1, sigma_y=1):
+    m, n = [(ss - 1.) / 2. for ss in shape]
+    y, x = np.ogrid[-m:m + 1, -n:n + 1]
+
+    h = np.exp(-(x * x / (2 * sigma_x * sigma_x) + y * y / (2 * sigma_y * sigma_y)))
+    h[h < np.finfo(h.dtype).eps * h.max()] = 0
+    return h
+
+
+def _reference_draw_truncate_gaussian(heatmap, center, h_radius, w_radius):
+    h, w = 2 * h_radius + 1, 2 * w_radius + 1
+    gaussian = _reference_gaussian_2d((h, w), sigma_x=w / 6, sigma_y=h / 6)
+    gaussian = heatmap.new_tensor(gaussian)
+
+    x, y = int(center[0]), int(center[1])
+    height, width = heatmap.shape[0:2]
+
+    left, right = min(x, w_radius), min(width - x, w_radius + 1)
+    top, bottom = min(y, h_radius), min(height - y, h_radius + 1)
+
+    masked_heatmap = heatmap[y - top:y + bottom, x - left:x + right]
+    masked_gaussian = gaussian[h_radius - top:h_radius + bottom,
+                               w_radius - left:w_radius + right]
+    if min(masked_gaussian.shape) > 0 and min(masked_heatmap.shape) > 0:
+        torch.max(masked_heatmap, masked_gaussian, out=masked_heatmap)
+    return heatmap
+
+
+def _reference_target_single_image(head, gt_boxes, gt_labels, feat_shape):
+    """The per-box loop TTFHead used before the targets were batched, with
+    box_target returned channels-last."""
+    from mmdet.core import bbox_areas
+    from mmdet.core.anchor.guided_anchor_target import calc_region
+
+    output_h, output_w = feat_shape
+    heatmap = gt_boxes.new_zeros((head.num_fg, output_h, output_w))
+    fake_heatmap = gt_boxes.new_zeros((output_h, output_w))
+    box_target = gt_boxes.new_ones((head.wh_planes, output_h, output_w)) * -1
+    reg_weight = gt_boxes.new_zeros((head.wh_planes // 4, output_h, output_w))
+
+    boxes_areas_log = bbox_areas(gt_boxes).log()
+    boxes_area_topk_log, boxes_ind = torch.topk(boxes_areas_log, boxes_areas_log.size(0))
+    gt_boxes = gt_boxes[boxes_ind]
+    gt_labels = gt_labels[boxes_ind]
+
+    feat_gt_boxes = gt_boxes / head.down_ratio
+    feat_gt_boxes[:, [0, 2]] = torch.clamp(feat_gt_boxes[:, [0, 2]], min=0, max=output_w - 1)
+    feat_gt_boxes[:, [1, 3]] = torch.clamp(feat_gt_boxes[:, [1, 3]], min=0, max=output_h - 1)
+    feat_hs, feat_ws = (feat_gt_boxes[:, 3] - feat_gt_boxes[:, 1],
+                        feat_gt_boxes[:, 2] - feat_gt_boxes[:, 0])
+
+    ct_ints = (torch.stack([(gt_boxes[:, 0] + gt_boxes[:, 2]) / 2,
+                            (gt_boxes[:, 1] + gt_boxes[:, 3]) / 2],
+                           dim=1) / head.down_ratio).to(torch.int)
+
+    h_radiuses_alpha = (feat_hs / 2. * head.alpha).int()
+    w_radiuses_alpha = (feat_ws / 2. * head.alpha).int()
+    h_radiuses_beta = (feat_hs / 2. * head.beta).int()
+    w_radiuses_beta = (feat_ws / 2. * head.beta).int()
+
+    r1 = (1 - head.beta) / 2
+    ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s = calc_region(gt_boxes.transpose(0, 1), r1)
+    ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s = [torch.round(x.float() / head.down_ratio).int()
+                                          for x in [ctr_x1s, ctr_y1s, ctr_x2s, ctr_y2s]]
+    ctr_x1s, ctr_x2s = [torch.clamp(x, max=output_w - 1) for x in [ctr_x1s, ctr_x2s]]
+    ctr_y1s, ctr_y2s = [torch.clamp(y, max=output_h - 1) for y in [ctr_y1s, ctr_y2s]]
+
+    for k in range(boxes_ind.shape[0]):
+        cls_id = gt_labels[k] - 1
+
+        fake_heatmap = fake_heatmap.zero_()
+        _reference_draw_truncate_gaussian(fake_heatmap, ct_ints[k],
+                                          h_radiuses_alpha[k].item(),
+                                          w_radiuses_alpha[k].item())
+        heatmap[cls_id] = torch.max(heatmap[cls_id], fake_heatmap)
+
+        if head.wh_gaussian:
+            if head.alpha != head.beta:
+                fake_heatmap = fake_heatmap.zero_()
+                _reference_draw_truncate_gaussian(fake_heatmap, ct_ints[k],
+                                                  h_radiuses_beta[k].item(),
+                                                  w_radiuses_beta[k].item())
+            box_target_inds = fake_heatmap > 0
+        else:
+            ctr_x1, ctr_y1, ctr_x2, ctr_y2 = ctr_x1s[k], ctr_y1s[k], ctr_x2s[k], ctr_y2s[k]
+            box_target_inds = torch.zeros_like(fake_heatmap, dtype=torch.bool)
+            box_target_inds[ctr_y1:ctr_y2 + 1, ctr_x1:ctr_x2 + 1] = 1
+
+        if head.wh_agnostic:
+            box_target[:, box_target_inds] = gt_boxes[k][:, None]
+            cls_id = 0
+        else:
+            box_target[(cls_id * 4):((cls_id + 1) * 4), box_target_inds] = gt_boxes[k][:, None]
+
+        if head.wh_gaussian:
+            local_heatmap = fake_heatmap[box_target_inds]
+            ct_div = local_heatmap.sum()
+            local_heatmap *= boxes_area_topk_log[k]
+            reg_weight[cls_id, box_target_inds] = local_heatmap / ct_div
+        else:
+            reg_weight[cls_id, box_target_inds] = \
+                boxes_area_topk_log[k] / box_target_inds.sum().float()
+
+    return heatmap, box_target.permute(1, 2, 0), reg_weight
+
+
+def _random_overlapping_boxes(rng, num_boxes, num_classes=3, img_size=256):
+    ctrs = rng.uniform(64, img_size - 64, size=(num_boxes, 2))
+    sizes = rng.uniform(8, 120, size=(num_boxes, 2))
+    boxes = np.concatenate([ctrs - sizes / 2, ctrs + sizes / 2], axis=1)
+    boxes = boxes.clip(0, img_size - 1)
+    labels = rng.randint(1, num_classes + 1, size=num_boxes)
+    return torch.Tensor(boxes), torch.LongTensor(labels)
+
+
+def test_ttf_head_target_generator_matches_reference():
+    rng = np.random.RandomState(0)
+    gt_bboxes, gt_labels = zip(*[_random_overlapping_boxes(rng, num_boxes)
+                                 for num_boxes in (9, 5, 1)])
+    img_metas = [{'pad_shape': (256, 256, 3)} for _ in gt_bboxes]
+
+    for wh_gaussian in (True, False):
+        for wh_agnostic in (True, False):
+            for alpha, beta in ((0.54, 0.54), (0.54, 0.7)):
+                head = _build_ttf_head(wh_gaussian=wh_gaussian, wh_agnostic=wh_agnostic,
+                                       alpha=alpha, beta=beta)
+                targets = head.target_generator(list(gt_bboxes), list(gt_labels), img_metas)
+                targets = [t.clone() for t in targets]
+
+                for img_id, (boxes, labels) in enumerate(zip(gt_bboxes, gt_labels)):
+                    ref_targets = _reference_target_single_image(
+                        head, boxes.clone(), labels.clone(), (64, 64))
+                    for target, ref_target in zip(targets, ref_targets):
+                        assert target[img_id].shape == ref_target.shape
+                        assert torch.allclose(target[img_id], ref_target, atol=1e-6)
+
+
+def test_ttf_head_loss():
+    head = _build_ttf_head()
+    gt_bboxes, gt_labels, img_metas = _demo_targets_inputs()
+    heatmap, box_target, reg_weight = [t.clone() for t in head.target_generator(
+        gt_bboxes, gt_labels, img_metas)]
+
+    # the exact (l, t, r, b) distances to the box targets at the positive locations.
+    ys, xs = torch.meshgrid(torch.arange(64.) * 4, torch.arange(64.) * 4)
+    pos = reg_weight[:, 0] > 0
+    pred_wh = torch.stack((xs - box_target[..., 0], ys - box_target[..., 1],
+                           box_target[..., 2] - xs, box_target[..., 3] - ys), dim=1)
+    pred_wh *= pos[:, None].float()
+    pred_heatmap = torch.randn(2, 80, 64, 64)
+
+    losses = head.loss(pred_heatmap, pred_wh, gt_bboxes, gt_labels, img_metas, None)
+    hm_loss, wh_loss = losses['losses/ttfnet_loss_heatmap'], losses['losses/ttfnet_loss_wh']
+    assert torch.isfinite(hm_loss).all() and torch.isfinite(wh_loss).all()
+    assert wh_loss.abs().max() < 1e-5
+
+    # the scripted heatmap loss against the eager formula.
+    pred = pred_heatmap.sigmoid().clamp(min=1e-4, max=1 - 1e-4)
+    pos_inds = heatmap.eq(1).float()
+    neg_inds = heatmap.lt(1).float()
+    pos_loss = -torch.log(pred) * (1 - pred).pow(2) * pos_inds
+    neg_loss = -torch.log(1 - pred) * pred.pow(2) * (1 - heatmap).pow(4) * neg_inds
+    ref_hm_loss = (pos_loss.sum() + neg_loss.sum()) / pos_inds.sum() * head.hm_weight
+    assert torch.allclose(hm_loss, ref_hm_loss)
+
+    wh_losses = head.loss(pred_heatmap, pred_wh + 2, gt_bboxes, gt_labels, img_metas, None)
+    assert wh_losses['losses/ttfnet_loss_wh'].item() > 0
+
+
+def test_ttf_head_get_bboxes():
+    import mmcv
+    head = _build_ttf_head()
+    _, _, img_metas = _demo_targets_inputs()
+    pred_heatmap = torch.rand(2, 80, 64, 64)
+    pred_wh = torch.rand(2, 4, 64, 64) * 16
+    cfg = mmcv.Config(dict(score_thr=0.01, max_per_img=100))
+
+    results = head.get_bboxes(pred_heatmap, pred_wh, img_metas, cfg, rescale=True)
+    assert len(results) == 2
+    for bboxes, labels in results:
+        assert bboxes.shape[1] == 5
+        assert bboxes.shape[0] == labels.shape[0] <= 100
+        assert (bboxes[:, 4] > 0.01).all()
+        assert ((labels >= 0) & (labels < 80)).all()
+
+
+def test_ttf_head_get_bboxes_planted_peak():
+    import mmcv
+    cfg = mmcv.Config(dict(score_thr=0.01, max_per_img=100))
+    img_metas = [{'pad_shape': (192, 256, 3), 'img_shape': (192, 256, 3), 'scale_factor': 1.0}]
+    cls_id, y, x = 5, 10, 40
+
+    for wh_agnostic in (True, False):
+        head = _build_ttf_head(wh_agnostic=wh_agnostic)
+        # a non-square map, so that swapping the height and width shows up.
+        pred_heatmap = torch.full((1, 80, 48, 64), -10.)
+        pred_heatmap[0, cls_id, y, x] = 10.
+        pred_wh = torch.zeros(1, head.wh_planes, 48, 64)
+        wh_channel = 0 if wh_agnostic else cls_id * 4
+        pred_wh[0, wh_channel:wh_channel + 4, y, x] = torch.Tensor([3., 4., 5., 6.])
+
+        (bboxes, labels), = head.get_bboxes(pred_heatmap, pred_wh, img_metas, cfg)
+        assert bboxes.shape == (1, 5)
+        assert torch.equal(bboxes[0, :4], torch.Tensor([157., 36., 165., 46.]))
+        assert labels.tolist() == [cls_id]
+
+
+def _planted_peaks_inputs(device='cpu'):
+    # well separated scores and integer wh, which are exact in half precision.
+    pred_heatmap = torch.full((2, 80, 64, 64), -10., device=device)
+    pred_wh = torch.zeros(2, 4, 64, 64, device=device)
+    for i, (img_id, cls_id, y, x) in enumerate([(0, 3, 5, 9), (0, 3, 40, 20), (0, 70, 60, 63),
+                                                (1, 0, 0, 0), (1, 12, 31, 32)]):
+        pred_heatmap[img_id, cls_id, y, x] = i - 2.
+        pred_wh[img_id, :, y, x] = torch.Tensor([1. + i, 2., 3., 4. + 2 * i])
+    return pred_heatmap, pred_wh
+
+
+def test_ttf_head_get_bboxes_half_cpu():
+    import mmcv
+    head = _build_ttf_head()
+    _, _, img_metas = _demo_targets_inputs()
+    cfg = mmcv.Config(dict(score_thr=0.01, max_per_img=100))
+    pred_heatmap, pred_wh = _planted_peaks_inputs()
+
+    results = head.get_bboxes(pred_heatmap, pred_wh, img_metas, cfg)
+    half_results = head.get_bboxes(pred_heatmap.half(), pred_wh.half(), img_metas, cfg)
+    for (bboxes, labels), (half_bboxes, half_labels) in zip(results, half_results):
+        assert torch.allclose(bboxes, half_bboxes)
+        assert torch.equal(labels, half_labels)
+
+
+def test_ttf_head_get_bboxes_half_gpu():
+    import mmcv
+    if not torch.cuda.is_available():
+        import pytest
+        pytest.skip('test requires GPU and torch+cuda')
+
+    head = _build_ttf_head().cuda()
+    _, _, img_metas = _demo_targets_inputs()
+    cfg = mmcv.Config(dict(score_thr=0.01, max_per_img=100))
+    pred_heatmap, pred_wh = _planted_peaks_inputs('cuda')
+
+    results = head.get_bboxes(pred_heatmap, pred_wh, img_metas, cfg)
+    half_results = head.get_bboxes(pred_heatmap.half(), pred_wh.half(), img_metas, cfg)
+    for (bboxes, labels), (half_bboxes, half_labels) in zip(results, half_results):
+        assert bboxes.shape[0] == half_bboxes.shape[0] > 0
+        # the scores are computed in half precision.
+        assert torch.allclose(bboxes[:, :4], half_bboxes[:, :4])
+        assert torch.allclose(bboxes[:, 4], half_bboxes[:, 4], atol=1e-3)
+        assert torch.equal(labels, half_labels)
+
+
+def test_ttf_head_channels_last():
+    import mmcv
+    import pytest
+    if not hasattr(torch, 'channels_last'):
+        pytest.skip('test requires torch>=1.5')
+
+    head = _build_ttf_head()
+    # the layout is set on construction, init_weights is not needed.
+    from mmdet.models.anchor_heads import TTFHead
+    cl_head = TTFHead(inplanes=(64, 128, 256, 512), head_conv=128, wh_conv=64,
+                      hm_head_conv_num=2, wh_head_conv_num=1, num_classes=81,
+                      wh_offset_base=16, channels_last=True)
+    assert cl_head.hm[-1].weight.is_contiguous(memory_format=torch.channels_last)
+    assert cl_head.wh[-1].weight.is_contiguous(memory_format=torch.channels_last)
+    cl_head.load_state_dict(head.state_dict())
+    head.eval()
+    cl_head.eval()
+
+    # the tail of forward, the upsampling layers are deformable convs which need cuda.
+    x = torch.rand(2, 64, 64, 64)
+    with torch.no_grad():
+        hm, wh = head.hm(x), head.wh(x)
+        cl_x = x.contiguous(memory_format=torch.channels_last)
+        cl_hm, cl_wh = cl_head.hm(cl_x), cl_head.wh(cl_x)
+    assert cl_hm.is_contiguous(memory_format=torch.channels_last)
+    assert cl_wh.is_contiguous(memory_format=torch.channels_last)
+    assert torch.allclose(hm, cl_hm, atol=1e-5)
+    assert torch.allclose(wh, cl_wh, atol=1e-5)
+
+    _, _, img_metas = _demo_targets_inputs()
+    cfg = mmcv.Config(dict(score_thr=0.01, max_per_img=100))
+    pred_heatmap, pred_wh = _planted_peaks_inputs()
+    cl_pred_heatmap = pred_heatmap.contiguous(memory_format=torch.channels_last)
+    cl_pred_wh = pred_wh.contiguous(memory_format=torch.channels_last)
+    results = head.get_bboxes(pred_heatmap, pred_wh, img_metas, cfg)
+    cl_results = cl_head.get_bboxes(cl_pred_heatmap, cl_pred_wh, img_metas, cfg)
+    for (bboxes, labels), (cl_bboxes, cl_labels) in zip(results, cl_results):
+        assert torch.allclose(bboxes, cl_bboxes)
+        assert torch.equal(labels, cl_labels)
+
+    gt_bboxes, gt_labels, img_metas = _demo_targets_inputs()
+    pred_wh = torch.rand(2, 4, 64, 64) * 16
+    losses = head.loss(pred_heatmap, pred_wh, gt_bboxes, gt_labels, img_metas, None)
+    cl_losses = cl_head.loss(cl_pred_heatmap, pred_wh.contiguous(memory_format=torch.channels_last),
+                             gt_bboxes, gt_labels, img_metas, None)
+    for name, loss in losses.items():
+        assert torch.allclose(loss, cl_losses[name])
+
+
+def test_ttf_head_channels_last_forward_gpu():
+    if not torch.cuda.is_available():
+        import pytest
+        pytest.skip('test requires GPU and torch+cuda')
+
+    head = _build_ttf_head().cuda().eval()
+    cl_head = _build_ttf_head(channels_last=True).cuda().eval()
+    cl_head.load_state_dict(head.state_dict())
+    feats = [torch.rand(1, 64, 128, 128).cuda(), torch.rand(1, 128, 64, 64).cuda(),
+             torch.rand(1, 256, 32, 32).cuda(), torch.rand(1, 512, 16, 16).cuda()]
+    with torch.no_grad():
+        outs = head(feats)
+        cl_outs = cl_head(feats)
+    for out, cl_out in zip(outs, cl_outs):
+        assert cl_out.is_contiguous(memory_format=torch.channels_last)
+        assert torch.allclose(out, cl_out, atol=1e-4)
+
+
+def test_ttf_head_export():
+    import mmcv
+    import pytest
+    from mmdet.models.anchor_heads.ttf_head import ShortcutConv2d
+    if not hasattr(torch.jit, 'optimize_for_inference'):
+        pytest.skip('test requires torch>=1.10')
+
+    head = _build_ttf_head()
+    state_dict = head.state_dict()
+    exported_head = head.export()
+
+    # the head itself is left untouched.
+    assert head.training and not exported_head.training
+    assert all(isinstance(layer, ShortcutConv2d) for layer in head.shortcut_layers)
+    assert not isinstance(head.postprocess, torch.jit.ScriptModule)
+    assert isinstance(exported_head.postprocess, torch.jit.ScriptModule)
+    exported_state_dict = head.state_dict()
+    assert list(exported_state_dict.keys()) == list(state_dict.keys())
+    for name, param in state_dict.items():
+        assert torch.equal(param, exported_state_dict[name])
+
+    head.eval()
+    feats = [torch.rand(1, 64, 32, 32), torch.rand(1, 128, 16, 16),
+             torch.rand(1, 256, 8, 8)]
+    with torch.no_grad():
+        for layer, exported_layer, feat in zip(head.shortcut_layers,
+                                               exported_head.shortcut_layers, feats[::-1]):
+            assert torch.allclose(layer(feat), exported_layer(feat), atol=1e-5)
+
+    _, _, img_metas = _demo_targets_inputs()
+    pred_heatmap = torch.rand(2, 80, 64, 64)
+    pred_wh = torch.rand(2, 4, 64, 64) * 16
+    cfg = mmcv.Config(dict(score_thr=0.01, max_per_img=100))
+    results = head.get_bboxes(pred_heatmap, pred_wh, img_metas, cfg)
+    exported_results = exported_head.get_bboxes(pred_heatmap, pred_wh, img_metas, cfg)
+    for (bboxes, labels), (exported_bboxes, exported_labels) in zip(results,
+                                                                    exported_results):
+        assert torch.allclose(bboxes, exported_bboxes)
+        assert torch.equal(labels, exported_labels)
+
+
+def test_ttf_head_pickle():
+    import io
+    import pickle
+    head = _build_ttf_head()
+    gt_bboxes, gt_labels, img_metas = _demo_targets_inputs()
+    head.target_generator(gt_bboxes, gt_labels, img_metas)
+
+    torch.save(head, io.BytesIO())
+    loaded_head = pickle.loads(pickle.dumps(head))
+
+    assert isinstance(loaded_head.postprocess, type(head.postprocess))
+    state_dict, loaded_state_dict = head.state_dict(), loaded_head.state_dict()
+    assert list(loaded_state_dict.keys()) == list(state_dict.keys())
+    for name, param in state_dict.items():
+        assert torch.equal(param, loaded_state_dict[name])